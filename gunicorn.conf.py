@@ -0,0 +1,18 @@
+# Gunicorn settings, picked up automatically from the working directory.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+
+# Requests spend most of their time waiting on GCS, so threads overlap that I/O.
+# Always a single worker process: the counter file (chip and amp counters) and
+# the local row store used without GCS_BUCKET are only guarded by locks inside
+# the process.  More instances are safe for the GCS row store, where an append
+# another instance made first is detected and the submit renumbered (see
+# DataLogger._append_rows), but each instance keeps its own counter file, so
+# the first chip of a new date comes from whichever instance takes that submit.
+worker_class = "gthread"
+workers = 1
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+
+# Restart a worker that stops responding; App Engine has no watchdog of its own
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
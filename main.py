@@ -1,12 +1,24 @@
-from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, make_response
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, make_response, \
+    after_this_request
+from flask.json.provider import JSONProvider
 import os
-import io
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 import re
-import json
-from datetime import datetime
+import uuid
+import itertools
+import orjson
+from datetime import datetime, timedelta, timezone
 import openpyxl
-from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.styles import Font, PatternFill, Alignment, NamedStyle
 from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
 import dateutil.parser
 
 # Optional GCS support
@@ -14,20 +26,106 @@ GCS_BUCKET = os.getenv("GCS_BUCKET", "").strip()
 GCS_ENABLED = bool(GCS_BUCKET)
 if GCS_ENABLED:
     from google.cloud import storage
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+    import google.auth
+    from google.auth.transport.requests import AuthorizedSession
+    from requests.adapters import HTTPAdapter
+
+_USER_KEY_RE = re.compile(r'[^A-Za-z0-9_-]+')
+_NON_DIGIT_RE = re.compile(r'\D')
+# barcoded_cell_sample_name: P<chip>_<well>
+_BCSN_RE = re.compile(r'^P(\d{4})_(\d+)$')
+# Plate well index typed either way round: 1A / 12A / A1 / A12
+_INDEX_RE = re.compile(r'(\d{1,2})([A-Z])|([A-Z])(\d{1,2})')
+# Common date spellings tried with strptime before the (slow) dateutil fallback;
+# month-first only, to agree with dateutil's default parsing
+_DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%Y%m%d')
+
+
+class RowStoreConflict(Exception):
+    """Another submit appended to the same log after this one read it."""
+
+
+class OrjsonProvider(JSONProvider):
+    """Route jsonify() and request.json through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'marmoset'
+app.json = OrjsonProvider(app)
 
 
 class DataLogger:
+    _HEADERS = ('krienen_lab_identifier', 'seq_portal', 'elab_link', 'experiment_start_date',
+                'mit_name', 'donor_name', 'tissue_name', 'tissue_name_old',
+                'dissociated_cell_sample_name', 'facs_population_plan', 'cell_prep_type',
+                'study', 'enriched_cell_sample_container_name', 'expc_cell_capture',
+                'port_well', 'enriched_cell_sample_name', 'enriched_cell_sample_quantity_count',
+                'barcoded_cell_sample_name', 'library_method', 'cDNA_amplification_method',
+                'cDNA_amplification_date', 'amplified_cdna_name', 'cDNA_pcr_cycles',
+                'rna_amplification_pass_fail', 'percent_cdna_longer_than_400bp',
+                'cdna_amplified_quantity_ng', 'cDNA_library_input_ng', 'library_creation_date',
+                'library_prep_set', 'library_name', 'tapestation_avg_size_bp',
+                'library_num_cycles', 'lib_quantification_ng', 'library_prep_pass_fail',
+                'r1_index', 'r2_index', 'ATAC_index')
+    # 0-based positions within a row record
+    _HEADER_IDX = {header: i for i, header in enumerate(_HEADERS)}
+    _ATAC_INDEX_COL = _HEADER_IDX['ATAC_index']
+    _TISSUE_OLD_COL = _HEADER_IDX['tissue_name_old']
+
+    # Comma-separated per-reaction numeric form fields and their types
+    _NUMERIC_FIELDS = (('cdna_concentration', float), ('percent_cdna_400bp', float),
+                       ('rna_lib_concentration', float), ('atac_lib_concentration', float),
+                       ('cdna_pcr_cycles', int), ('rna_sizes', int), ('library_cycles_rna', int),
+                       ('atac_sizes', int), ('library_cycles_atac', int))
+
+    # amp_counter entries older than this are dropped; the sheet scan rebuilds them from the rows
+    _AMP_COUNTER_DAYS = 365
+
+    # Shards folded into the base by one compaction (a compose takes at most 32 sources)
+    _COMPACT_SHARDS = 31
+    # Shards younger than this (by their GCS creation time) are left unfolded
+    _COMPACT_MIN_AGE = timedelta(minutes=10)
+    # A submit that is still appending this long after reading the log reads it
+    # again; kept well under _COMPACT_MIN_AGE so the shard number it picked
+    # cannot have been taken, folded and deleted in between
+    _APPEND_DEADLINE = timedelta(minutes=5)
+    # Tries per submit when another instance appends to the same log first
+    _SUBMIT_ATTEMPTS = 3
+
+    # Shared style objects; openpyxl deduplicates them in the styles table
+    _HEADER_FONT = Font(name="Arial", size=10, bold=True)
+    _CELL_FONT = Font(name="Arial", size=10)
+    _CELL_ALIGN = Alignment(horizontal='left')
+    _BLACK_FILL = PatternFill(start_color='000000', fill_type='solid')
+
     def __init__(self):
         # Local storage (fallback when GCS not enabled)
         self.config_dir = os.path.join(os.path.expanduser('~'), 'DataLogApp')
         os.makedirs(self.config_dir, exist_ok=True)
         self.counter_file = os.path.join(self.config_dir, 'sample_name_counter.json')
-
-        # GCS client
-        self.storage_client = storage.Client() if GCS_ENABLED else None
+        self._counter_lock = threading.Lock()
+        # user_key -> lock held across a submit's read-modify-write; see _user_lock
+        self._user_locks = {}
+        self._user_locks_guard = threading.Lock()
+
+        # GCS client and bucket handle, shared by every blob operation
+        self.storage_client = self._make_storage_client() if GCS_ENABLED else None
+        self._bucket = self.storage_client.bucket(GCS_BUCKET) if GCS_ENABLED else None
+        # Parallel blob fetches; sized to fit the HTTP connection pool
+        self._gcs_pool = ThreadPoolExecutor(max_workers=16) if GCS_ENABLED else None
+        # object_name -> rows already read from the row store; see _load_rows
+        self._rows_cache = {}
+        # user_key -> log object name; see _load_pointer
+        self._pointer_cache = {}
+        # object_name -> ScanState of the rows last scanned; see _scan_log_state
+        self._scan_cache = {}
 
         self.name_to_code = {
             "Petra": "CJ23.56.001",
@@ -71,7 +169,12 @@ class DataLogger:
             "Lapras": "CJ25.56.017"
         }
 
-        self.black_fill = PatternFill(start_color='000000', fill_type='solid')
+    def _make_storage_client(self):
+        # One pooled keep-alive session so pointer/row requests reuse TLS connections
+        credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+        session = AuthorizedSession(credentials)
+        session.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+        return storage.Client(project=project, credentials=credentials, _http=session)
 
     # ----------------- User key and object names -----------------
 
@@ -79,323 +182,608 @@ class DataLogger:
         name = (name or "").strip()
         if not name:
             return "unknown"
-        return re.sub(r'[^A-Za-z0-9_-]+', '_', name) or "unknown"
+        return _USER_KEY_RE.sub('_', name) or "unknown"
 
-    # ----------------- Workbook storage helpers (GCS/local) -----------------
+    # ----------------- Row store helpers (GCS/local) -----------------
+    # Rows are kept in an append-only JSONL store next to the xlsx name held by
+    # the pointer; the xlsx itself is only built on download.  Locally the store
+    # is a single file; on GCS every submit adds the next numbered shard under
+    # "<log>/shards/" (after an optional single-object "<log>.jsonl" base), and
+    # reads periodically fold old shards into the base; see _compact_rows.
 
     def _new_object_name(self, user_key: str) -> str:
         ts = datetime.now().strftime('%Y%m%d_%H%M%S')
         return f"logs/{user_key}/{user_key}_krienen_data_log_{ts}.xlsx"
 
+    def _rows_object_name(self, object_name: str) -> str:
+        return os.path.splitext(object_name)[0] + '.jsonl'
+
+    def _shard_prefix(self, object_name: str) -> str:
+        return os.path.splitext(object_name)[0] + '/shards/'
+
+    def _local_path(self, object_name: str) -> str:
+        return os.path.join(self.config_dir, object_name.replace("/", os.sep))
+
     def _load_pointer(self, user_key: str):
+        # Pointers are only ever written when missing, so one that has been read
+        # back stays valid.  Our own uploads are not cached: if two instances race
+        # to create a pointer, the loser picks up the winner's on its next read.
+        object_name = self._pointer_cache.get(user_key)
+        if object_name:
+            return object_name
         if GCS_ENABLED:
-            bucket = self.storage_client.bucket(GCS_BUCKET)
-            blob = bucket.blob(f"pointers/{user_key}.json")
-            if blob.exists():
-                try:
-                    data = json.loads(blob.download_as_text())
-                    if isinstance(data, dict) and data.get("object"):
-                        return data["object"]
-                except Exception:
-                    pass
-        # local fallback mapping (optional)
-        mapping = self._load_local_meta().get("current_log_objects", {})
-        return mapping.get(user_key)
+            blob = self._bucket.blob(f"pointers/{user_key}.json")
+            # Just try the GET: a missing pointer (NotFound) costs one round trip, not two
+            try:
+                data = orjson.loads(blob.download_as_bytes())
+                if isinstance(data, dict) and data.get("object"):
+                    object_name = data["object"]
+            except (NotFound, orjson.JSONDecodeError):
+                # No pointer yet, or a garbled one: fall back to the local mapping.
+                # Anything else (auth, 5xx) is left to fail the request.
+                pass
+        if not object_name:
+            # local fallback mapping (optional)
+            mapping = self._load_local_meta().get("current_log_objects", {})
+            object_name = mapping.get(user_key)
+        if object_name:
+            self._pointer_cache[user_key] = object_name
+        return object_name
 
     def _save_pointer(self, user_key: str, object_name: str):
+        self._upload_pointer(user_key, object_name)
+        with self._edit_local_meta() as meta:
+            meta.setdefault("current_log_objects", {})[user_key] = object_name
+
+    def _upload_pointer(self, user_key: str, object_name: str):
         if GCS_ENABLED:
-            bucket = self.storage_client.bucket(GCS_BUCKET)
-            blob = bucket.blob(f"pointers/{user_key}.json")
-            blob.upload_from_string(json.dumps({"object": object_name}, indent=2), content_type="application/json")
-        meta = self._load_local_meta()
-        meta.setdefault("current_log_objects", {})[user_key] = object_name
-        self._save_local_meta(meta)
-
-    def _download_workbook(self, object_name):
+            blob = self._bucket.blob(f"pointers/{user_key}.json")
+            blob.upload_from_string(orjson.dumps({"object": object_name}), content_type="application/json")
+
+    def _latest_object_name(self, user_key: str):
+        """
+        Find the user's newest existing log, for when the pointer has been lost.
+        Log names end in a %Y%m%d_%H%M%S timestamp, so the newest sorts last.
+        """
+        prefix = f"logs/{user_key}/{user_key}_krienen_data_log_"
         if GCS_ENABLED:
-            bucket = self.storage_client.bucket(GCS_BUCKET)
-            blob = bucket.blob(object_name)
-            if blob.exists():
-                data = blob.download_as_bytes()
-                wb = load_workbook(io.BytesIO(data))
-                return wb, blob.generation
-            else:
-                wb = self._initialize_excel()
-                return wb, None
+            # The delimiter keeps shard objects out of the listing; their folders come back as prefixes
+            blobs = self._bucket.list_blobs(prefix=prefix, delimiter='/')
+            names = [b.name for b in blobs] + [p.rstrip('/') for p in blobs.prefixes]
         else:
-            local_path = os.path.join(self.config_dir, object_name.replace("/", os.sep))
-            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            log_dir = os.path.join(self.config_dir, 'logs', user_key)
+            names = [f"logs/{user_key}/{n}" for n in os.listdir(log_dir)] if os.path.isdir(log_dir) else []
+        stems = set()
+        for name in names:
+            if name.startswith(prefix):
+                stem, ext = os.path.splitext(name)
+                stems.add(stem if ext in ('.xlsx', '.jsonl') else name)
+        return max(stems) + '.xlsx' if stems else None
+
+    def _current_object_name(self, user_key: str):
+        """
+        Resolve the log a user is writing to.  Returns (object_name, new_pointer,
+        created): when new_pointer is True the caller should save the pointer, and
+        created means the name was just minted, so the log has no rows yet.
+        """
+        object_name = self._load_pointer(user_key)
+        if object_name:
+            return object_name, False, False
+        object_name = self._latest_object_name(user_key)
+        if object_name:
+            return object_name, True, False
+        return self._new_object_name(user_key), True, True
+
+    def _list_sources(self, object_name):
+        """
+        GCS only.  One listing finds the row store blobs (base first, then the
+        shards in name order) and any legacy xlsx.  Returns (sources, folded,
+        legacy_blob), where `folded` are shards the base already holds whose
+        delete after _compact_rows failed; they are left out of `sources`.
+        """
+        rows_name = self._rows_object_name(object_name)
+        prefix = os.path.splitext(object_name)[0]
+        shard_prefix = self._shard_prefix(object_name)
+        blobs = {b.name: b for b in self._bucket.list_blobs(prefix=prefix)}
+        base = blobs.get(rows_name)
+        folded_names = set(self._folded_shards(base))
+        sources, folded = ([base] if base is not None else []), []
+        for name in sorted(blobs):
+            if name.startswith(shard_prefix):
+                (folded if name[len(shard_prefix):] in folded_names else sources).append(blobs[name])
+        return sources, folded, blobs.get(object_name)
+
+    def _folded_shards(self, base):
+        # Names (relative to the shard prefix) of the shards the last compaction folded into the base
+        folded = (base.metadata or {}).get("folded", "") if base is not None else ""
+        return folded.split(",") if folded else []
+
+    def _read_rows(self, object_name):
+        """
+        Open a log for reading.  Returns (records, in_store): a lazy iterator
+        over its {"modality": ..., "row": [...]} records, and whether those come
+        from the row store (False for rows imported from a pre-row-store xlsx).
+        """
+        if GCS_ENABLED:
+            try:
+                return self._read_blob_rows(object_name)
+            except NotFound:
+                # Another instance compacted shards away mid-read; the next listing won't show them
+                return self._read_blob_rows(object_name)
+        else:
+            local_path = self._local_path(self._rows_object_name(object_name))
             if os.path.exists(local_path):
-                wb = load_workbook(local_path)
-            else:
-                wb = self._initialize_excel()
-            return wb, None
+                return self._iter_file_rows(local_path), True
+            legacy_path = self._local_path(object_name)
+            if os.path.exists(legacy_path):
+                return iter(self._rows_from_workbook(legacy_path)), False
+            return iter(()), True
+
+    def _read_blob_rows(self, object_name):
+        sources, _, legacy_blob = self._list_sources(object_name)
+        if sources:
+            return self._iter_blob_rows(sources), True
+        if legacy_blob is not None:
+            return iter(self._rows_from_legacy_blob(legacy_blob)), False
+        return iter(()), True
+
+    def _load_rows(self, object_name):
+        """
+        Read every row of a log into memory.  Returns (rows, stored): `stored` is
+        how many of the rows are already in the row store.  Row store reads are
+        cached per log, keyed by what was read (file inode/offset, or blob
+        names/generations), so a later call only fetches rows appended since.
+        The caller gets its own list and may append to it.
+        """
+        if GCS_ENABLED:
+            try:
+                return self._load_blob_rows(object_name)
+            except NotFound:
+                # Another instance compacted shards away mid-read; the next listing won't show them
+                return self._load_blob_rows(object_name)
+
+        local_path = self._local_path(self._rows_object_name(object_name))
+        try:
+            st = os.stat(local_path)
+        except FileNotFoundError:
+            legacy_path = self._local_path(object_name)
+            return (self._rows_from_workbook(legacy_path) if os.path.exists(legacy_path) else []), 0
+        inode, offset, rows = self._rows_cache.get(object_name, (st.st_ino, 0, []))
+        if inode != st.st_ino or offset > st.st_size:
+            inode, offset, rows = st.st_ino, 0, []
+        if offset < st.st_size:
+            with open(local_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(st.st_size - offset)
+            # Stop at the last complete line; a concurrent append may be mid-write
+            end = data.rfind(b"\n") + 1
+            rows = rows + self._rows_from_bytes(data[:end])
+            self._rows_cache[object_name] = (inode, offset + end, rows)
+        return list(rows), len(rows)
+
+    def _load_blob_rows(self, object_name):
+        sources, folded, legacy_blob = self._list_sources(object_name)
+        if not sources:
+            rows = self._rows_from_legacy_blob(legacy_blob) if legacy_blob is not None else []
+            return rows, 0
+        token = tuple((b.name, b.generation) for b in sources)
+        cached_token, rows, _ = self._rows_cache.get(object_name, ((), [], None))
+        if token[:len(cached_token)] != cached_token:
+            # Rewritten, or a shard landed before ones already read: start over
+            cached_token, rows = (), []
+        new_sources = sources[len(cached_token):]
+        if new_sources:
+            rows = rows + list(self._iter_blob_rows(new_sources))
+        # Kept with the rows so _append_rows claims the shard after the ones just read
+        self._rows_cache[object_name] = (token, rows, self._next_shard_seq(object_name, sources, folded))
+        if len(sources) > self._COMPACT_SHARDS:
+            self._compact_rows(object_name, sources, folded)
+        return list(rows), len(rows)
+
+    def _next_shard_seq(self, object_name, sources, folded):
+        # Shards are numbered 1, 2, ... in append order; folded ones keep their numbers taken
+        shard_prefix = self._shard_prefix(object_name)
+        names = [b.name[len(shard_prefix):] for b in sources + folded if b.name.startswith(shard_prefix)]
+        if sources and sources[0].name == self._rows_object_name(object_name):
+            names += self._folded_shards(sources[0])
+        seqs = [int(stem) for stem in (os.path.splitext(n)[0] for n in names) if stem.isdigit()]
+        return max(seqs, default=0) + 1
+
+    def _compact_rows(self, object_name, sources, folded):
+        """
+        Fold the oldest shards into the base with a single compose, so listings
+        and cold reads stay small.  The base records exactly which shards it
+        took, and listings skip those until they are deleted.  Best effort: if
+        the compose fails (e.g. another instance compacted first) the shards are
+        simply left in place.
+        """
+        # The base only remembers its last fold, so shards left over from that
+        # one must be gone before another fold replaces the list
+        if not all(self._gcs_pool.map(self._delete_shard, folded)):
+            return
+        rows_name = self._rows_object_name(object_name)
+        shard_prefix = self._shard_prefix(object_name)
+        base = sources[0] if sources[0].name == rows_name else None
+        shards = sources[1:] if base is not None else sources
+        # GCS creation times, so instance clocks don't matter
+        cutoff = datetime.now(timezone.utc) - self._COMPACT_MIN_AGE
+        # A leading run, so the new base is still followed by the remaining shards in order
+        to_fold = list(itertools.takewhile(lambda b: b.time_created is not None and b.time_created < cutoff,
+                                           shards[:self._COMPACT_SHARDS]))
+        if len(to_fold) < self._COMPACT_SHARDS:
+            return
+        blob = self._bucket.blob(rows_name)
+        blob.content_type = 'application/x-ndjson'
+        blob.metadata = {"folded": ",".join(b.name[len(shard_prefix):] for b in to_fold)}
+        try:
+            # The generation precondition makes racing compactions fail rather than drop rows
+            blob.compose(([base] if base is not None else []) + to_fold,
+                         if_generation_match=base.generation if base is not None else 0)
+        except Exception:
+            return
+        # The new base holds exactly the rows of what it replaced, so the cache stays valid
+        replaced = len(to_fold) + (base is not None)
+        token, rows, seq = self._rows_cache.get(object_name, ((), [], None))
+        if blob.generation is not None and token[:replaced] == tuple((b.name, b.generation) for b in sources[:replaced]):
+            self._rows_cache[object_name] = (((rows_name, blob.generation),) + token[replaced:], rows, seq)
+        list(self._gcs_pool.map(self._delete_shard, to_fold))
+
+    def _delete_shard(self, blob):
+        try:
+            blob.delete(if_generation_match=blob.generation)
+        except NotFound:
+            pass
+        except Exception:
+            return False
+        return True
+
+    def _iter_file_rows(self, path):
+        with open(path, 'rb') as f:
+            for line in f:
+                if line.strip():
+                    yield orjson.loads(line)
+
+    def _iter_blob_rows(self, sources):
+        # Spool to a temp file rather than holding the whole store in memory.
+        # The download happens before this returns, so callers see NotFound here.
+        tmp = tempfile.TemporaryFile()
+        try:
+            self._download_composed(sources, tmp)
+        except BaseException:
+            tmp.close()
+            raise
+        tmp.seek(0)
+        return self._iter_spooled_rows(tmp)
+
+    def _iter_spooled_rows(self, tmp):
+        with tmp:
+            for line in tmp:
+                if line.strip():
+                    yield orjson.loads(line)
+
+    def _download_composed(self, sources, file_obj):
+        """
+        Write the concatenation of several row store blobs into file_obj.  Up to
+        32 blobs are fetched in parallel; larger logs first compose each group of
+        32 (in parallel) into a temporary staging blob, keeping the GET count low.
+        """
+        groups = [sources[i:i + 32] for i in range(0, len(sources), 32)]
+        staging = []
+        if len(groups) > 1:
+            staging = [self._bucket.blob(f"tmp/compose_{uuid.uuid4().hex}.jsonl") for _ in groups]
+        try:
+            if staging:
+                list(self._gcs_pool.map(lambda blob, group: blob.compose(group), staging, groups))
+            # map() yields in submission order, so rows keep their order
+            for data in self._gcs_pool.map(lambda blob: blob.download_as_bytes(), staging or sources):
+                file_obj.write(data)
+        finally:
+            for blob in staging:
+                try:
+                    blob.delete()
+                except Exception:
+                    pass
 
-    def _upload_workbook(self, wb, object_name, if_generation_match=None):
+    def _append_rows(self, object_name, rows, stored):
+        """
+        Persist rows[stored:] after the rows already in the row store, and add
+        them to the rows cache so the next submit doesn't read them back.  On
+        GCS, raises RowStoreConflict if another instance appended to the log
+        since _load_rows read it.
+        """
+        rows_name = self._rows_object_name(object_name)
+        data = b"".join(orjson.dumps(r, default=str) + b"\n" for r in rows[stored:])
+        # Cache what a fresh read would return (e.g. dates as strings), not the inputs
+        written = self._rows_from_bytes(data)
         if GCS_ENABLED:
-            bucket = self.storage_client.bucket(GCS_BUCKET)
-            blob = bucket.blob(object_name)
-            out = io.BytesIO()
-            wb.save(out)
-            out.seek(0)
-            if if_generation_match is not None:
-                blob.upload_from_file(
-                    out,
-                    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                    if_generation_match=if_generation_match
-                )
-            else:
-                blob.upload_from_file(
-                    out,
-                    content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-                )
+            # A log that was never read (just created, or imported from xlsx) has no shards yet
+            token, cached, seq = self._rows_cache.get(object_name, ((), [], 1))
+            blob = self._bucket.blob(f"{self._shard_prefix(object_name)}{seq:010d}.jsonl")
+            try:
+                # Creating the next numbered shard is the claim on the log: if it
+                # already exists, another instance appended after our read, and
+                # everything numbered from that read is stale
+                blob.upload_from_string(data, content_type='application/x-ndjson', if_generation_match=0)
+            except PreconditionFailed:
+                raise RowStoreConflict("Another submit to this log was saved at the same time")
+            if blob.generation is not None:
+                self._rows_cache[object_name] = (token + ((blob.name, blob.generation),), cached + written, seq + 1)
         else:
-            local_path = os.path.join(self.config_dir, object_name.replace("/", os.sep))
+            local_path = self._local_path(rows_name)
             os.makedirs(os.path.dirname(local_path), exist_ok=True)
-            wb.save(local_path)
+            # One write per submit, so concurrent appends don't interleave
+            with open(local_path, 'ab') as f:
+                start = f.tell()
+                f.write(data)
+                inode = os.fstat(f.fileno()).st_ino
+            cached_inode, offset, cached = self._rows_cache.get(object_name, (inode, 0, []))
+            # Only extend when nothing else was appended since the cached read
+            if cached_inode == inode and offset == start:
+                self._rows_cache[object_name] = (inode, start + len(data), cached + written)
+
+    def _rows_from_bytes(self, data):
+        return [orjson.loads(line) for line in data.splitlines() if line.strip()]
+
+    def _rows_from_legacy_blob(self, blob):
+        with tempfile.TemporaryFile() as tmp:
+            blob.download_to_file(tmp)
+            tmp.seek(0)
+            return self._rows_from_workbook(tmp)
+
+    def _rows_from_workbook(self, source):
+        """Import the rows of an xlsx log written before the row store existed."""
+        # read_only streams the sheet XML instead of building every styled cell
+        wb = load_workbook(source, read_only=True)
+        try:
+            ws = wb.active
+            method_col = self._HEADER_IDX['library_method']
+            rows = []
+            for cells in ws.iter_rows(min_row=2):
+                values = [cell.value for cell in cells]
+                if all(v is None for v in values):
+                    continue
+                modality = "ATAC" if values[method_col] == "10xMultiome-ASeq" else "RNA"
+                if modality == "ATAC":
+                    # Empty strings read back as None; on ATAC rows only real None cells were
+                    # blacked out.  Cells absent from the sheet come back with no fill at all.
+                    values = ['' if v is None and (cell.fill is None or cell.fill.fill_type is None) else v
+                              for v, cell in zip(values, cells)]
+                rows.append({"modality": modality, "row": values})
+        finally:
+            wb.close()
+        return rows
+
+    def _build_workbook_file(self, object_name, path):
+        """Stream the log's rows into a write-only workbook saved at path."""
+        rows, _ = self._read_rows(object_name)
+
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("HMBA")
+        # Setting a named style is one lookup per cell, where font + alignment (+ fill)
+        # each hash into the style tables.  Styles bind to a workbook: build them per file.
+        wb.add_named_style(NamedStyle("header", font=self._HEADER_FONT, alignment=self._CELL_ALIGN))
+        wb.add_named_style(NamedStyle("body", font=self._CELL_FONT, alignment=self._CELL_ALIGN))
+        wb.add_named_style(NamedStyle("blacked", font=self._CELL_FONT, alignment=self._CELL_ALIGN,
+                                      fill=self._BLACK_FILL))
+
+        header_cells = []
+        for value in self._HEADERS:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.style = "header"
+            header_cells.append(cell)
+        ws.append(header_cells)
+
+        for record in rows:
+            modality = record["modality"]
+            cells = []
+            for col, value in enumerate(record["row"]):
+                cell = WriteOnlyCell(ws, value=value)
+                if ((modality == "ATAC" and value is None) or
+                        (modality == "RNA" and col == self._ATAC_INDEX_COL) or col == self._TISSUE_OLD_COL):
+                    cell.style = "blacked"
+                else:
+                    cell.style = "body"
+                cells.append(cell)
+            ws.append(cells)
 
-    def _download_workbook_bytes(self, object_name):
-        if GCS_ENABLED:
-            bucket = self.storage_client.bucket(GCS_BUCKET)
-            blob = bucket.blob(object_name)
-            if blob.exists():
-                return blob.download_as_bytes()
-            else:
-                wb = self._initialize_excel()
-                out = io.BytesIO()
-                wb.save(out)
-                return out.getvalue()
-        else:
-            local_path = os.path.join(self.config_dir, object_name.replace("/", os.sep))
-            if os.path.exists(local_path):
-                with open(local_path, 'rb') as f:
-                    return f.read()
-            else:
-                wb = self._initialize_excel()
-                out = io.BytesIO()
-                wb.save(out)
-                return out.getvalue()
+        wb.save(path)
 
     # ----------------- Per-user state (local meta fallback only) -----------------
 
     def _load_local_meta(self):
         if os.path.exists(self.counter_file):
             try:
-                with open(self.counter_file, 'r') as f:
-                    return json.load(f)
+                with open(self.counter_file, 'rb') as f:
+                    return orjson.loads(f.read())
             except Exception:
                 return {}
         return {}
 
-    def _save_local_meta(self, meta: dict):
-        with open(self.counter_file, 'w') as f:
-            json.dump(meta, f, indent=4)
+    def _write_local_meta(self, data: bytes):
+        # Write-then-rename so readers never see a truncated file
+        tmp_path = f"{self.counter_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.counter_file)
 
-    # ----------------- Core utilities -----------------
+    @contextmanager
+    def _edit_local_meta(self):
+        """
+        Load the counter file for a read-modify-write and save it once when the
+        block exits, unless nothing changed.  The lock makes each edit atomic
+        against other edits of the file; changes computed from state read before
+        the block also need the user's _user_lock held across both.
+        """
+        with self._counter_lock:
+            meta = self._load_local_meta()
+            # date_info is keyed by convert_date(), which is None for an unparseable
+            # date; like json.dump, write that key as "null" instead of failing
+            before = orjson.dumps(meta, option=orjson.OPT_NON_STR_KEYS)
+            yield meta
+            after = orjson.dumps(meta, option=orjson.OPT_NON_STR_KEYS)
+            if after != before:
+                self._write_local_meta(after)
+
+    def _user_lock(self, user_key: str):
+        # One lock per user, created on first use; only serialises this process
+        with self._user_locks_guard:
+            return self._user_locks.setdefault(user_key, threading.Lock())
 
-    def _headers(self):
-        return ['krienen_lab_identifier', 'seq_portal', 'elab_link', 'experiment_start_date',
-                'mit_name', 'donor_name', 'tissue_name', 'tissue_name_old',
-                'dissociated_cell_sample_name', 'facs_population_plan', 'cell_prep_type',
-                'study', 'enriched_cell_sample_container_name', 'expc_cell_capture',
-                'port_well', 'enriched_cell_sample_name', 'enriched_cell_sample_quantity_count',
-                'barcoded_cell_sample_name', 'library_method', 'cDNA_amplification_method',
-                'cDNA_amplification_date', 'amplified_cdna_name', 'cDNA_pcr_cycles',
-                'rna_amplification_pass_fail', 'percent_cdna_longer_than_400bp',
-                'cdna_amplified_quantity_ng', 'cDNA_library_input_ng', 'library_creation_date',
-                'library_prep_set', 'library_name', 'tapestation_avg_size_bp',
-                'library_num_cycles', 'lib_quantification_ng', 'library_prep_pass_fail',
-                'r1_index', 'r2_index', 'ATAC_index']
-
-    def _initialize_excel(self):
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "HMBA"
-        ws.append(self._headers())
-        for col_num in range(1, len(self._headers()) + 1):
-            cell = ws.cell(row=1, column=col_num)
-            cell.font = Font(name="Arial", size=10, bold=True)
-            cell.alignment = Alignment(horizontal='left')
-        return wb
+    # ----------------- Core utilities -----------------
 
     def convert_date(self, exp_date):
-        clean = "".join(c for c in exp_date if c.isdigit())
+        clean = _NON_DIGIT_RE.sub('', exp_date)
         if len(clean) == 6:
             try:
                 datetime.strptime(clean, '%y%m%d')
                 return clean
             except ValueError:
                 pass
+        # Date picker / ISO input: handled by the C parser
+        try:
+            return datetime.fromisoformat(exp_date.replace('Z', '+00:00')).strftime('%y%m%d')
+        except ValueError:
+            pass
+        for fmt in _DATE_FORMATS:
+            try:
+                return datetime.strptime(exp_date, fmt).strftime('%y%m%d')
+            except ValueError:
+                pass
         try:
             parsed = dateutil.parser.parse(exp_date)
             return parsed.strftime('%y%m%d')
         except ValueError:
             return None
 
-    def convert_index(self, index):
-        index = index.strip().upper()
-        if len(index) == 3:
-            if index[0].isdigit() and index[1].isdigit() and index[2].isalpha():
-                return f"{index[2]}{index[0]}{index[1]}"
-            elif index[0].isalpha() and index[1].isdigit() and index[2].isdigit():
-                return index
-        elif len(index) == 2:
-            if index[0].isdigit() and index[1].isalpha():
-                return f"{index[1]}0{index[0]}"
-            elif index[0].isalpha() and index[1].isdigit():
-                return f"{index[0]}0{index[1]}"
-        return None
-
-    def pad_index(self, index):
-        if len(index) == 2 and index[0].isalpha() and index[1].isdigit():
-            return f"{index[0]}0{index[1]}"
-        return index
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def convert_index(index):
+        # Pure and called per typed index; the set of distinct inputs is tiny
+        m = _INDEX_RE.fullmatch(index.strip().upper())
+        if m is None:
+            return None
+        digits, letter = (m.group(1), m.group(2)) if m.group(1) else (m.group(4), m.group(3))
+        return f"{letter}{digits.zfill(2)}"
 
     # ----------------- Sheet-derived state helpers -----------------
 
-    def _sheet_max_chip(self, ws):
+    def _scan_sheet_state(self, rows, current_date, amp_prefix, amp_date, start=None):
         """
-        Scan the entire sheet to find the highest chip number (P####) across
-        ALL dates.  Returns 0 if no barcoded_cell_sample_name rows exist.
+        One pass over the rows for everything a submit reconciles against: the
+        highest chip (P####) across all dates, chip -> highest used well on
+        current_date, and where the amplified_cdna_name sequence
+        f"{amp_prefix}_{amp_date}_{batch}_{letter}" (A..H, then next batch) stands,
+        for amp_prefix and for every AP prefix together.  Every count is a maximum, so a ScanState for earlier rows (same dates and
+        prefix) can be passed as `start` to scan only the rows after them.
         """
-        headers = [cell.value for cell in ws[1]]
-        bcsn_col = headers.index('barcoded_cell_sample_name') + 1
-        max_chip = 0
-        for row_idx in range(2, ws.max_row + 1):
-            name_val = ws.cell(row=row_idx, column=bcsn_col).value
-            if not name_val or not isinstance(name_val, str):
-                continue
-            m = re.match(r'^P(\d{4})_(\d+)$', name_val)
-            if m:
-                max_chip = max(max_chip, int(m.group(1)))
-        return max_chip
-
-    def _sheet_date_chip_usage(self, ws, current_date):
-        """
-        Scan the sheet for rows with experiment_start_date == current_date
-        and build a map of chip -> highest used well for that date.
-        barcoded_cell_sample_name format: 'P####_##'
-        """
-        headers = [cell.value for cell in ws[1]]
-        date_col = headers.index('experiment_start_date') + 1
-        bcsn_col = headers.index('barcoded_cell_sample_name') + 1
+        date_col = self._HEADER_IDX['experiment_start_date']
+        bcsn_col = self._HEADER_IDX['barcoded_cell_sample_name']
+        amp_name_col = self._HEADER_IDX['amplified_cdna_name']
+        amp_re = re.compile(rf'^(AP.*)_{re.escape(str(amp_date))}_(\d+)_([A-H])$')
+
+        max_chip = start.max_chip if start else 0
+        chips_map = dict(start.chips_map) if start else {}  # chip_str -> used_wells (int)
+        # Reaction count of the next amp name: batch 1 letter A is 0
+        amp_next = start.amp_next if start else 0
+        amp_next_any = start.amp_next_any if start else 0
+
+        for record in rows:
+            row = record["row"]
+            # barcoded_cell_sample_name format: 'P####_##'
+            name_val = row[bcsn_col]
+            if name_val and isinstance(name_val, str):
+                m = _BCSN_RE.match(name_val)
+                if m:
+                    chip = int(m.group(1))
+                    max_chip = max(max_chip, chip)
+                    if row[date_col] == current_date:
+                        well = int(m.group(2))
+                        chips_map[str(chip)] = max(well, chips_map.get(str(chip), 0))
+
+            # Example: APLCTX_251001_1_G
+            val = row[amp_name_col]
+            if val and isinstance(val, str):
+                m = amp_re.match(val)
+                if m:
+                    position = (int(m.group(2)) - 1) * 8 + ord(m.group(3)) - 64
+                    amp_next_any = max(amp_next_any, position)
+                    if m.group(1) == amp_prefix:
+                        amp_next = max(amp_next, position)
 
-        chips_map = {}  # chip_str -> used_wells (int)
         last_chip = None
-        last_used = 0
-
-        for row_idx in range(2, ws.max_row + 1):
-            date_val = ws.cell(row=row_idx, column=date_col).value
-            if date_val != current_date:
-                continue
-            name_val = ws.cell(row=row_idx, column=bcsn_col).value
-            if not name_val or not isinstance(name_val, str):
-                continue
-            m = re.match(r'^P(\d{4})_(\d+)$', name_val)
-            if not m:
-                continue
-            chip = int(m.group(1))
-            well = int(m.group(2))
-            chips_map[str(chip)] = max(well, int(chips_map.get(str(chip), 0)))
         if chips_map:
             # Highest chip that has entries on this date
             last_chip = max(int(c) for c in chips_map.keys())
-            last_used = int(chips_map[str(last_chip)])
-        return chips_map, last_chip, last_used
 
-    def _next_amp_name(self, ws, amp_prefix, amp_date):
+        return ScanState(max_chip, chips_map, last_chip, amp_next, amp_next_any)
+
+    def _scan_log_state(self, object_name, rows, current_date, amp_prefix, amp_date):
         """
-        Determine the next amplified_cdna_name by scanning existing rows in the sheet:
-        pattern: f"{amp_prefix}_{amp_date}_{batch}_{letter}"
-        letter cycles A..H; after H, batch increments.
+        _scan_sheet_state, cached per log.  When the rows extend the ones last
+        scanned for the same dates and prefix, only the new rows are scanned.
         """
-        headers = [cell.value for cell in ws[1]]
-        amp_name_col = headers.index('amplified_cdna_name') + 1
-
-        last_batch = 0
-        last_letter = None  # 'A'..'H'
-
-        for row_idx in range(2, ws.max_row + 1):
-            val = ws.cell(row=row_idx, column=amp_name_col).value
-            if not val or not isinstance(val, str):
-                continue
-            # Example: APLCTX_251001_1_G
-            m = re.match(rf'^{re.escape(amp_prefix)}_{re.escape(amp_date)}_(\d+)_([A-H])$', val)
-            if not m:
-                continue
-            b = int(m.group(1))
-            L = m.group(2)
-            if b > last_batch or (b == last_batch and (last_letter is None or L > last_letter)):
-                last_batch = b
-                last_letter = L
-
-        if last_batch == 0:
-            # No prior reactions for this amp date
-            return f"{amp_prefix}_{amp_date}_1_A"
-
-        # Compute next letter/batch
-        letters = 'ABCDEFGH'
-        if last_letter is None:
-            # Shouldn't happen but default safely
-            return f"{amp_prefix}_{amp_date}_{last_batch}_A"
-        idx = letters.index(last_letter)
-        if idx < 7:
-            next_letter = letters[idx + 1]
-            next_batch = last_batch
-        else:
-            next_letter = 'A'
-            next_batch = last_batch + 1
-
-        return f"{amp_prefix}_{amp_date}_{next_batch}_{next_letter}"
+        params = (current_date, amp_prefix, amp_date)
+        cached_params, scanned, last_record, scan = self._scan_cache.get(object_name, (None, 0, None, None))
+        # Rows that come through the rows cache keep their record objects, so an
+        # identity check on the last scanned one tells an extension from a reload
+        if cached_params != params or len(rows) < scanned or (scanned and rows[scanned - 1] is not last_record):
+            scanned, scan = 0, None
+        if scan is None or scanned < len(rows):
+            scan = self._scan_sheet_state(rows[scanned:], current_date, amp_prefix, amp_date, start=scan)
+            self._scan_cache[object_name] = (params, len(rows), rows[-1] if rows else None, scan)
+        return scan
 
     # ----------------- Business logic -----------------
 
     # ----------------- Business logic -----------------
 
-    def process_form_data(self, form_data):
+    def process_form_data(self, inputs):
+        """
+        Log one /submit.  Reading the user's state and rows, numbering the
+        chips, wells and amp names, appending the rows and saving the counters
+        all happen under the user's lock, so concurrent submits (or an
+        /update_counter) for the same user in this process can't hand out the
+        same numbers or overwrite each other's counters.  A submit another
+        process or instance appended first is caught by _append_rows; the
+        numbering is then redone against the rows it just wrote.
+        """
+        user_key = self._safe_user_key(inputs.user_first_name)
+        with self._user_lock(user_key):
+            for attempt in range(self._SUBMIT_ATTEMPTS):
+                try:
+                    return self._process_form_data(inputs, user_key)
+                except RowStoreConflict:
+                    if attempt == self._SUBMIT_ATTEMPTS - 1:
+                        raise
+
+    def _process_form_data(self, inputs, user_key):
         # Import heavy modules only when needed
         from openpyxl.utils import get_column_letter
 
         # 1. Setup user workbook and state
-        user_first_name = form_data.get('user_first_name', '').strip()
-        user_key = self._safe_user_key(user_first_name)
-
-        object_name = self._load_pointer(user_key)
-        if not object_name:
-            object_name = self._new_object_name(user_key)
-            self._save_pointer(user_key, object_name)
-
-        workbook, generation = self._download_workbook(object_name)
-        worksheet = workbook.active
+        object_name, new_pointer, created = self._current_object_name(user_key)
 
-        # Determine actual last row
-        last_row_with_content = 1
-        for row_idx in range(1, worksheet.max_row + 1):
-            for cell in worksheet[row_idx]:
-                if cell.value is not None:
-                    last_row_with_content = row_idx
-                    break
-        current_row = last_row_with_content + 1
+        # A freshly minted log has nothing to read back
+        rows, stored = ([], 0) if created else self._load_rows(object_name)
+        read_at = time.monotonic()
 
         # Load web app user state
-        meta = self._load_local_meta()
-        states = meta.setdefault('user_states', {})
-        state = states.setdefault(user_key, {"next_counter": 90, "date_info": {}, "amp_counter": {}})
+        states = self._load_local_meta().get('user_states', {})
+        state = states.get(user_key) or {"next_counter": 90, "date_info": {}, "amp_counter": {}}
         if "date_info" not in state: state["date_info"] = {}
         if "amp_counter" not in state: state["amp_counter"] = {}
         if "next_counter" not in state or state["next_counter"] is None: state["next_counter"] = 90
+        amp_cutoff = "amp_" + (datetime.now() - timedelta(days=self._AMP_COUNTER_DAYS)).strftime('%y%m%d')
+        state["amp_counter"] = {k: v for k, v in state["amp_counter"].items() if k >= amp_cutoff}
 
-        # Get values from form_data dictionary
-        current_date = self.convert_date(form_data.get('date', ''))
-        mit_name_input = form_data.get('marmoset', '')
-        mit_name = "cj" + mit_name_input
-        donor_name = self.name_to_code.get(mit_name_input, mit_name_input)
-
-        slab_raw = form_data.get('slab', '').strip()
-        hemisphere = form_data.get('hemisphere', '').split()[0].upper() if form_data.get('hemisphere') else ''
+        # Get values from the parsed form inputs
+        current_date = self.convert_date(inputs.date)
+        mit_name = "cj" + inputs.marmoset
+        donor_name = self.name_to_code.get(inputs.marmoset, inputs.marmoset)
 
-        # Split comma-separated slabs and process each one
-        slab_parts = [s.strip() for s in slab_raw.split(',') if s.strip()]
+        hemisphere = inputs.hemisphere
+        # Comma-separated slabs, already stripped in FormInputs
+        slab_parts = inputs.slab_parts
         # Raw slabs (zero-padded only, no hemisphere offset) for krienen_lab_identifier
         raw_slabs = [s.zfill(2) if s.isdigit() else s for s in slab_parts]
         # Offset slabs (with hemisphere adjustment) for tissue_name
@@ -419,28 +807,32 @@ class DataLogger:
         slab_for_tissue = "_".join(processed_slabs)
         # For krienen_lab_identifier: original slab numbers without hemisphere offset
         slab_for_id = "_".join(raw_slabs)
-        # Keep slab as offset version for backward compat with other uses
-        slab = processed_slabs[0] if processed_slabs else slab_raw
 
-        tile_value = form_data.get('tile', '').strip()
+        tile_value = inputs.tile
         tile = str(int(tile_value)).zfill(2) if tile_value.isdigit() else tile_value
 
-        tile_location_abbr = form_data.get('tile_location', '')
+        tile_location_abbr = inputs.tile_location
+        sort_method = inputs.sort_method
+        rxn_number = inputs.rxn_number
 
-        sort_method = form_data.get('sort_method', '')
-        sort_method = sort_method.upper() if sort_method.lower() == "dapi" else sort_method
+        study = inputs.project
+        is_aim4 = (study == 'HMBA_Aim4')
+        # Aim4 = RNA only; Multiome = RNA + ATAC
+        modalities = ["RNA"] if is_aim4 else ["RNA", "ATAC"]
 
-        if sort_method.lower() == "pooled":
-            facs_population = form_data.get('facs_population', '')
-        elif sort_method.lower() == "unsorted":
-            facs_population = "no_FACS"
-        else:
-            facs_population = "DAPI"
+        # Dates are converted once here, not per reaction and modality
+        dates = {"RNA": self.convert_date(inputs.rna_prep_date),
+                 "cdna_amp": self.convert_date(inputs.cdna_amp_date)}
+        if "ATAC" in modalities:
+            dates["ATAC"] = self.convert_date(inputs.atac_prep_date)
 
-        try:
-            rxn_number = int(form_data.get('rxn_number', 1))
-        except ValueError:
-            rxn_number = 1
+        cdna_amp_date = dates["cdna_amp"]
+        if not cdna_amp_date:
+            cdna_amp_date = current_date  # Fallback if empty
+        amp_prefix = f"AP{inputs.sorter_initials}{'TX' if is_aim4 else 'XR'}"
+
+        # Every sheet-derived count below comes from this single pass
+        scan = self._scan_log_state(object_name, rows, current_date, amp_prefix, cdna_amp_date)
 
         # ==========================================
         # UPDATED LOGIC FOR COLUMN R (PXXXX counter)
@@ -450,12 +842,12 @@ class DataLogger:
 
         # --- Reconcile global next_counter with sheet if state looks default ---
         if state.get("next_counter", 90) == 90 and not state.get("date_info"):
-            global_max_chip = self._sheet_max_chip(worksheet)
+            global_max_chip = scan.max_chip
             if global_max_chip >= 90:
                 state["next_counter"] = global_max_chip + 1
 
         # --- Reconcile state with what's actually in the sheet ---
-        chips_map, sheet_last_chip, sheet_last_used = self._sheet_date_chip_usage(worksheet, current_date)
+        chips_map, sheet_last_chip = scan.chips_map, scan.last_chip
 
         # Compute total reactions from sheet: sum of max wells across all chips for this date
         sheet_total_reactions = sum(int(v) for v in chips_map.values()) if chips_map else 0
@@ -506,12 +898,9 @@ class DataLogger:
         base_p_number = date_entry["p_number"]
 
         # Port_well cycles 1-8; after 8, chip number increments
-        port_wells = []
-        for x in range(rxn_number):
-            absolute_idx = existing_total + x  # 0-indexed reaction count
-            p_number = base_p_number + (absolute_idx // 8)
-            port_well = (absolute_idx % 8) + 1  # 1-8
-            port_wells.append((p_number, port_well))
+        # divmod of the 0-indexed reaction count gives (chip offset, well - 1)
+        port_wells = [(base_p_number + chip, well + 1)
+                      for chip, well in (divmod(existing_total + x, 8) for x in range(rxn_number))]
 
         date_entry["total_reactions"] = existing_total + rxn_number
         # Ensure next_counter stays ahead of the highest chip we just used
@@ -519,137 +908,195 @@ class DataLogger:
         state["next_counter"] = max(state.get("next_counter", 90), highest_chip_used + 1)
         # ==========================================
 
-        atac_indices_raw = form_data.get('atac_indices', '')
-        atac_indices = [self.pad_index(self.convert_index(i)) if self.convert_index(i) else i for i in
-                        atac_indices_raw.split(',')] if atac_indices_raw else []
+        # One pass per list; unrecognised entries are kept as typed
+        atac_indices = [self.convert_index(i) or i for i in inputs.atac_indices]
+        rna_indices = [self.convert_index(i) or i for i in inputs.rna_indices]
 
-        rna_indices_raw = form_data.get('rna_indices', '')
-        rna_indices = [self.pad_index(self.convert_index(i)) if self.convert_index(i) else i for i in
-                       rna_indices_raw.split(',')] if rna_indices_raw else []
+        tissue_name = f"{donor_name}.{tile_location_abbr}.{slab_for_tissue}.{tile}"
 
-        seq_portal = "no"
-        elab_link = form_data.get('elab_link', '')
-        study = form_data.get('project', 'HMBA_CjAtlas_Subcortex')
-        is_aim4 = (study == 'HMBA_Aim4')
+        dup_index_counter = {}
 
-        tissue_name = f"{donor_name}.{tile_location_abbr}.{slab_for_tissue}.{tile}"
-        sample_suffix = "Rseq" if is_aim4 else "Multiome"
-        dissociated_cell_sample_name = f'{current_date}_{tissue_name}.{sample_suffix}'
-        cell_prep_type = "nuclei"
+        # Original slab numbers (no hemisphere offset) go in krienen_lab_identifier
+        slab_part = f"Slab{slab_for_id or slab_for_tissue}"
+        tile_part = f"Tile{int(tile)}" if tile.isdigit() else tile
+        identifier_prefix = f"{current_date}_HMBA_{mit_name}_{slab_part}_{tile_part}_{sort_method}_"
 
         sorting_status = "PS" if sort_method.lower() in ["pooled", "dapi"] else "PN"
-        sorter_initials = form_data.get('sorter_initials', '').strip().upper()
         enriched_prefix = "MPTX" if is_aim4 else "MPXM"
-        enriched_cell_sample_container_name = f"{enriched_prefix}_{current_date}_{sorting_status}_{sorter_initials}"
-
-        # Aim4 = RNA only; Multiome = RNA + ATAC
-        modalities = ["RNA"] if is_aim4 else ["RNA", "ATAC"]
+        sample_suffix = "Rseq" if is_aim4 else "Multiome"
+        container_name = f"{enriched_prefix}_{current_date}_{sorting_status}_{inputs.sorter_initials}"
+
+        # Columns shared by every row of this submit; per-reaction and per-modality
+        # columns are layered on top, and columns never set stay None
+        common = {
+            'seq_portal': "no",
+            'elab_link': inputs.elab_link,
+            'experiment_start_date': current_date,
+            'mit_name': mit_name,
+            'donor_name': donor_name,
+            'tissue_name': tissue_name,
+            'dissociated_cell_sample_name': f'{current_date}_{tissue_name}.{sample_suffix}',
+            'facs_population_plan': inputs.facs_population,
+            'cell_prep_type': "nuclei",
+            'study': study,
+            'enriched_cell_sample_container_name': container_name,
+            'expc_cell_capture': inputs.expected_cell_capture,
+            'enriched_cell_sample_quantity_count': inputs.cell_count,
+            'library_prep_pass_fail': "Pass",
+        }
 
-        dup_index_counter = {}
-        headers = [cell.value for cell in worksheet[1]]
+        # ==========================================
+        # UPDATED LOGIC FOR COLUMN V (cDNA counter)
+        # Reconciled with the sheet scan so counters
+        # survive server restarts.
+        # Every RNA row of a submit shares one amp date, so this runs once.
+        # ==========================================
+        amp_date_key = f"amp_{cdna_amp_date}"
+
+        # --- Reconcile amp_counter with sheet data ---
+        if amp_date_key not in state["amp_counter"]:
+            # State doesn't know about this amp date — continue after the sheet's last one.
+            # The counter is shared by every prefix, so one evicted for its age is
+            # rebuilt from the names of all of them.
+            state["amp_counter"][amp_date_key] = scan.amp_next_any if amp_date_key < amp_cutoff else scan.amp_next
+
+        # The counter file is per instance: continue after any names another one added
+        amp_start = max(state["amp_counter"][amp_date_key], scan.amp_next)
+        # One RNA row per reaction
+        state["amp_counter"][amp_date_key] = amp_start + rxn_number
+        # ==========================================
 
         for x in range(rxn_number):
             p_number, port_well = port_wells[x]
-            barcoded_cell_sample_name = f'P{str(p_number).zfill(4)}_{port_well}'
+            reaction = dict(common,
+                            port_well=port_well,
+                            enriched_cell_sample_name=f'{container_name}_{port_well}',
+                            barcoded_cell_sample_name=f'P{str(p_number).zfill(4)}_{port_well}')
 
             for modality in modalities:
-                self.write_modality_data(
-                    worksheet, current_row, modality, x, current_date, mit_name, slab_for_tissue, tile, sort_method,
-                    port_well, barcoded_cell_sample_name, form_data, tissue_name, rna_indices,
-                    atac_indices, headers, dup_index_counter, donor_name, study, state,
-                    slab_for_id=slab_for_id
-                )
-                current_row += 1
-
-        self._upload_workbook(workbook, object_name, generation if GCS_ENABLED else None)
-        self._save_local_meta(meta)
+                if modality == "RNA":
+                    # A through H, then the batch number goes up
+                    batch, letter_idx = divmod(amp_start + x, 8)
+                    amp_name = f"{amp_prefix}_{cdna_amp_date}_{batch + 1}_{chr(65 + letter_idx)}"
+                    library_type, library_index, fields = self._rna_fields(
+                        x, inputs, is_aim4, rna_indices, dates, amp_name)
+                else:
+                    library_type, library_index, fields = self._atac_fields(
+                        x, inputs, atac_indices, dates)
+
+                library_prep_date = dates[modality]
+                key = (library_type, library_prep_date, library_index)
+                dup_index_counter[key] = dup_index_counter.get(key, 0) + 1
+                library_prep_set = f"{library_type}_{library_prep_date}_{dup_index_counter[key]}"
+
+                fields.update(reaction)
+                fields['krienen_lab_identifier'] = f"{identifier_prefix}{modality}{x + 1}"
+                fields['library_creation_date'] = library_prep_date
+                fields['library_prep_set'] = library_prep_set
+                fields['library_name'] = f"{library_prep_set}_{library_index}"
+
+                # Styling (fonts, black fills) is applied when the xlsx is built on download
+                rows.append({"modality": modality, "row": [fields.get(h) for h in self._HEADERS]})
+
+        # See _APPEND_DEADLINE
+        if time.monotonic() - read_at > self._APPEND_DEADLINE.total_seconds():
+            raise RowStoreConflict("Submit took too long; reading the log again")
+        self._append_rows(object_name, rows, stored)
+        if new_pointer:
+            self._upload_pointer(user_key, object_name)
+        # Merge this user's state into a fresh read of the counter file: one write per submit
+        with self._edit_local_meta() as meta:
+            if new_pointer:
+                meta.setdefault("current_log_objects", {})[user_key] = object_name
+            meta.setdefault('user_states', {})[user_key] = state
         return True
 
-    def write_modality_data(self, worksheet, current_row, modality, x, current_date, mit_name, slab, tile, sort_method,
-                            port_well, barcoded_cell_sample_name, form_data, tissue_name_base, rna_indices,
-                            atac_indices, headers, dup_index_counter, donor_name, project, state,
-                            slab_for_id=None):
-
-        # slab_for_id = original slab numbers (no hemisphere offset) for krienen_lab_identifier
-        # slab = offset slab numbers for tissue_name
-        slab_part = f"Slab{slab_for_id or slab}"
-        tile_part = f"Tile{int(tile)}" if str(tile).isdigit() else tile
-
-        krienen_lab_identifier = f"{current_date}_HMBA_{mit_name}_{slab_part}_{tile_part}_{sort_method}_{modality}{x + 1}"
-
-        experimenter_initials = form_data.get('sorter_initials', '').strip().upper()
-        sorting_status = "PS" if sort_method.lower() in ["pooled", "dapi"] else "PN"
-        tissue_name = tissue_name_base
-
-        is_aim4 = (project == 'HMBA_Aim4')
-        sample_suffix = "Rseq" if is_aim4 else "Multiome"
-        dissociated_cell_sample_name = f'{current_date}_{tissue_name}.{sample_suffix}'
-        enriched_prefix = "MPTX" if is_aim4 else "MPXM"
+    def _rna_fields(self, x, inputs, is_aim4, rna_indices, dates, amp_name):
+        """
+        RNA-only columns of reaction x.  Returns (library_type, library_index, fields).
+        """
+        experimenter_initials = inputs.sorter_initials
         rna_suffix = "TX" if is_aim4 else "XR"
-        atac_suffix = "XA"
-
-        enriched_cell_sample_container_name = f"{enriched_prefix}_{current_date}_{sorting_status}_{experimenter_initials}"
-        enriched_cell_sample_name = f'{enriched_prefix}_{current_date}_{sorting_status}_{experimenter_initials}_{port_well}'
-
-        study = project
-        seq_portal = "no"
-        elab_link = form_data.get('elab_link', '')
-        facs_population = form_data.get('facs_population', 'no_FACS')
-        cell_prep_type = "nuclei"
-
-        library_prep_date = (self.convert_date(form_data.get('rna_prep_date', '')) if modality == "RNA"
-                             else self.convert_date(form_data.get('atac_prep_date', '')))
-
-        # Helper methods to safely extract comma separated inputs from the Web UI
-        def safe_float_split(val, idx):
-            try:
-                return float(str(val).split(',')[idx].strip())
-            except:
-                return 0.0
-
-        def safe_int_split(val, idx):
-            try:
-                return int(str(val).split(',')[idx].strip())
-            except:
-                return 0
-
-        if modality == "RNA":
-            library_method = "10xV4" if is_aim4 else "10xMultiome-RSeq"
-            library_type = f"LP{experimenter_initials}{rna_suffix}"
-            library_index = rna_indices[x] if x < len(rna_indices) else ""
-
-            cdna_concentration = safe_float_split(form_data.get('cdna_concentration', ''), x)
-            cdna_amplified_quantity = cdna_concentration * 40
-            cdna_library_input = cdna_amplified_quantity * 0.25
-            percent_cdna_400bp = safe_float_split(form_data.get('percent_cdna_400bp', ''), x)
-            rna_concentration = safe_float_split(form_data.get('rna_lib_concentration', ''), x)
-            lib_quant = rna_concentration * 35
-
-            cdna_pcr_cycles = safe_int_split(form_data.get('cdna_pcr_cycles', ''), x)
-            rna_size = safe_int_split(form_data.get('rna_sizes', ''), x)
-            library_cycles = safe_int_split(form_data.get('library_cycles_rna', ''), x)
-        else:
-            library_method = "10xMultiome-ASeq"  # ATAC only for Multiome, not Aim4
-            library_type = f"LP{experimenter_initials}{atac_suffix}"
-            library_index = atac_indices[x] if x < len(atac_indices) else ""
-
-            atac_concentration = safe_float_split(form_data.get('atac_lib_concentration', ''), x)
-            lib_quant = atac_concentration * 20
+        library_index = rna_indices[x] if x < len(rna_indices) else ""
+
+        # The comma separated inputs from the Web UI, parsed once per submit
+        numbers = inputs.numeric
+        cdna_amplified_quantity = numbers['cdna_concentration'][x] * 40
+        fields = {
+            'library_method': "10xV4" if is_aim4 else "10xMultiome-RSeq",
+            'cDNA_amplification_method': "10xV4" if is_aim4 else "10xMultiome-RSeq",
+            'cDNA_amplification_date': dates["cdna_amp"],
+            'cDNA_pcr_cycles': numbers['cdna_pcr_cycles'][x],
+            'rna_amplification_pass_fail': "Pass",
+            'percent_cdna_longer_than_400bp': numbers['percent_cdna_400bp'][x],
+            'cdna_amplified_quantity_ng': cdna_amplified_quantity,
+            'cDNA_library_input_ng': cdna_amplified_quantity * 0.25,
+            'tapestation_avg_size_bp': numbers['rna_sizes'][x],
+            'library_num_cycles': numbers['library_cycles_rna'][x],
+            'lib_quantification_ng': numbers['rna_lib_concentration'][x] * 35,
+            'r1_index': f"SI-TT-{library_index}_i7",
+            'r2_index': f"SI-TT-{library_index}_b(i5)",
+            'amplified_cdna_name': amp_name,
+        }
 
-            atac_size = safe_int_split(form_data.get('atac_sizes', ''), x)
-            library_cycles = safe_int_split(form_data.get('library_cycles_atac', ''), x)
+        return f"LP{experimenter_initials}{rna_suffix}", library_index, fields
 
-            cdna_concentration = None
-            cdna_amplified_quantity = None
-            cdna_library_input = None
-            percent_cdna_400bp = None
-            cdna_pcr_cycles = None
-            rna_size = None
+    def _atac_fields(self, x, inputs, atac_indices, dates):
+        """
+        ATAC-only columns of reaction x (Multiome only, never Aim4).  Returns
+        (library_type, library_index, fields).
+        """
+        library_index = atac_indices[x] if x < len(atac_indices) else ""
+        numbers = inputs.numeric
+        fields = {
+            'library_method': "10xMultiome-ASeq",
+            'tapestation_avg_size_bp': numbers['atac_sizes'][x],
+            'library_num_cycles': numbers['library_cycles_atac'][x],
+            'lib_quantification_ng': numbers['atac_lib_concentration'][x] * 20,
+            'ATAC_index': f"SI-NA-{library_index}",
+        }
+        return f"LP{inputs.sorter_initials}XA", library_index, fields
+
+@dataclass(frozen=True)
+class FormInputs:
+    """
+    Cleaned /submit fields, parsed once per request
+    """
+    user_first_name: str
+    date: str
+    marmoset: str
+    slab_parts: tuple
+    hemisphere: str
+    tile: str
+    tile_location: str
+    sort_method: str
+    facs_population: str
+    rxn_number: int
+    atac_indices: tuple
+    rna_indices: tuple
+    elab_link: str
+    project: str
+    sorter_initials: str
+    rna_prep_date: str
+    atac_prep_date: str
+    cdna_amp_date: str
+    expected_cell_capture: int
+    cell_count: int
+    # DataLogger._NUMERIC_FIELDS key -> one number per reaction (at least rxn_number)
+    numeric: dict
+
+    @classmethod
+    def from_json(cls, form_data):
+        slab = form_data.get('slab', '').strip()
+        hemisphere = form_data.get('hemisphere', '')
+        sort_method = form_data.get('sort_method', '')
+        atac_indices = form_data.get('atac_indices', '')
+        rna_indices = form_data.get('rna_indices', '')
 
-        key = (library_type, library_prep_date, library_index)
-        dup_index_counter[key] = dup_index_counter.get(key, 0) + 1
-        library_prep_set = f"{library_type}_{library_prep_date}_{dup_index_counter[key]}"
-        library_name = f"{library_prep_set}_{library_index}"
+        try:
+            rxn_number = int(form_data.get('rxn_number', 1))
+        except ValueError:
+            rxn_number = 1
 
         try:
             expected_cell_capture = int(form_data.get('expected_recovery', 0))
@@ -659,99 +1106,62 @@ class DataLogger:
         try:
             concentration = float(form_data.get('nuclei_concentration', '0').replace(",", ""))
             volume = float(form_data.get('nuclei_volume', '0'))
-            enriched_cell_sample_quantity_count = round(concentration * volume)
+            cell_count = round(concentration * volume)
         except ValueError:
-            enriched_cell_sample_quantity_count = 0
-
-        row_data = [
-            krienen_lab_identifier,
-            seq_portal,
-            elab_link,
-            current_date,
-            mit_name,
-            donor_name,
-            tissue_name,
-            None,
-            dissociated_cell_sample_name,
-            facs_population,
-            cell_prep_type,
-            study,
-            enriched_cell_sample_container_name,
-            expected_cell_capture,
-            port_well,
-            enriched_cell_sample_name,
-            enriched_cell_sample_quantity_count,
-            barcoded_cell_sample_name,
-            library_method,
-            ("10xV4" if is_aim4 else "10xMultiome-RSeq") if modality == "RNA" else None,
-            self.convert_date(form_data.get('cdna_amp_date', '')) if modality == "RNA" else None,
-            None,
-            cdna_pcr_cycles if modality == "RNA" else None,
-            "Pass" if modality == "RNA" else None,
-            percent_cdna_400bp if modality == "RNA" else None,
-            cdna_amplified_quantity if modality == "RNA" else None,
-            cdna_library_input if modality == "RNA" else None,
-            library_prep_date,
-            library_prep_set,
-            library_name,
-            rna_size if modality == "RNA" else atac_size,
-            library_cycles,
-            lib_quant,
-            "Pass",
-            f"SI-TT-{library_index}_i7" if modality == "RNA" else None,
-            f"SI-TT-{library_index}_b(i5)" if modality == "RNA" else None,
-            f"SI-NA-{library_index}" if modality == "ATAC" else None
-        ]
-
-        # ==========================================
-        # UPDATED LOGIC FOR COLUMN V (cDNA counter)
-        # Uses _next_amp_name to reconcile with sheet
-        # so counters survive server restarts.
-        # ==========================================
-        if modality == "RNA":
-            cdna_amp_date = self.convert_date(form_data.get('cdna_amp_date', ''))
-            if not cdna_amp_date:
-                cdna_amp_date = current_date  # Fallback if empty
-
-            amp_date_key = f"amp_{cdna_amp_date}"
-            amp_prefix = f"AP{experimenter_initials}{rna_suffix}"
-
-            # --- Reconcile amp_counter with sheet data ---
-            if amp_date_key not in state["amp_counter"]:
-                # State doesn't know about this amp date — check the sheet
-                next_name = self._next_amp_name(worksheet, amp_prefix, cdna_amp_date)
-                # Parse the next_name to figure out what counter value it implies
-                m = re.match(rf'^{re.escape(amp_prefix)}_{re.escape(cdna_amp_date)}_(\d+)_([A-H])$', next_name)
-                if m:
-                    batch = int(m.group(1))
-                    letter = m.group(2)
-                    # Convert batch+letter back to a reaction_count
-                    letter_idx = ord(letter) - 65  # A=0, B=1, ...
-                    state["amp_counter"][amp_date_key] = (batch - 1) * 8 + letter_idx
-                else:
-                    state["amp_counter"][amp_date_key] = 0
-
-            reaction_count = state["amp_counter"][amp_date_key]
-
-            letter = chr(65 + (reaction_count % 8))  # A through H
-            batch_num_for_amp = (reaction_count // 8) + 1  # 1, then 2, then 3...
-
-            row_data[21] = f"{amp_prefix}_{cdna_amp_date}_{batch_num_for_amp}_{letter}"
+            cell_count = 0
+
+        return cls(
+            user_first_name=form_data.get('user_first_name', '').strip(),
+            date=form_data.get('date', ''),
+            marmoset=form_data.get('marmoset', ''),
+            slab_parts=tuple(s.strip() for s in slab.split(',') if s.strip()),
+            hemisphere=hemisphere.split()[0].upper() if hemisphere else '',
+            tile=form_data.get('tile', '').strip(),
+            tile_location=form_data.get('tile_location', ''),
+            sort_method=sort_method.upper() if sort_method.lower() == "dapi" else sort_method,
+            facs_population=form_data.get('facs_population', 'no_FACS'),
+            rxn_number=rxn_number,
+            atac_indices=tuple(atac_indices.split(',')) if atac_indices else (),
+            rna_indices=tuple(rna_indices.split(',')) if rna_indices else (),
+            elab_link=form_data.get('elab_link', ''),
+            project=form_data.get('project', 'HMBA_CjAtlas_Subcortex'),
+            sorter_initials=form_data.get('sorter_initials', '').strip().upper(),
+            rna_prep_date=form_data.get('rna_prep_date', ''),
+            atac_prep_date=form_data.get('atac_prep_date', ''),
+            cdna_amp_date=form_data.get('cdna_amp_date', ''),
+            expected_cell_capture=expected_cell_capture,
+            cell_count=cell_count,
+            numeric={key: cls._split_numbers(form_data.get(key, ''), cast, rxn_number)
+                     for key, cast in DataLogger._NUMERIC_FIELDS},
+        )
 
-            state["amp_counter"][amp_date_key] += 1
-        # ==========================================
+    @staticmethod
+    def _split_numbers(value, cast, count):
+        """
+        Parse a comma separated form field into at least `count` numbers;
+        missing or unparseable entries become cast() (0 / 0.0).
+        """
+        numbers = []
+        for part in str(value).split(','):
+            try:
+                numbers.append(cast(part.strip()))
+            except ValueError:
+                numbers.append(cast())
+        numbers.extend(cast() for _ in range(count - len(numbers)))
+        return tuple(numbers)
 
-        for col_num, value in enumerate(row_data, start=1):
-            cell = worksheet.cell(row=current_row, column=col_num, value=value)
-            cell.font = Font(name="Arial", size=10)
-            cell.alignment = Alignment(horizontal='left')
 
-            if (modality == "ATAC" and value is None) or (
-                    modality == "RNA" and col_num == headers.index('ATAC_index') + 1):
-                cell.fill = self.black_fill
+@dataclass(frozen=True)
+class ScanState:
+    """
+    Sheet-derived counts from DataLogger._scan_sheet_state
+    """
+    max_chip: int
+    chips_map: dict
+    last_chip: Optional[int]
+    amp_next: int
+    amp_next_any: int
 
-        tissue_old_col = headers.index('tissue_name_old') + 1
-        worksheet.cell(row=current_row, column=tissue_old_col).fill = self.black_fill
 
 # favicon route (optional, for direct /favicon.ico requests)
 @app.route('/favicon.ico')
@@ -777,7 +1187,7 @@ def index():
 @app.route('/update_counter', methods=['POST'])
 def update_counter():
     try:
-        request_data = request.json or {}
+        request_data = request.get_json(cache=False) or {}
         # Accept user from JSON or query param
         user_first_name = (request_data.get('user_first_name') or request.args.get('user') or "").strip()
         if not user_first_name:
@@ -800,11 +1210,11 @@ def update_counter():
         # data_logger._save_user_state(user_key, state)
 
         # If you’re still using the local meta fallback:
-        meta = data_logger._load_local_meta()
-        states = meta.setdefault('user_states', {})
-        state = states.setdefault(user_key, {"next_counter": None, "date_info": {}, "amp_counter": {}})
-        state['next_counter'] = new_counter
-        data_logger._save_local_meta(meta)
+        # The user's lock keeps an in-flight submit from writing back its older state over this
+        with data_logger._user_lock(user_key), data_logger._edit_local_meta() as meta:
+            states = meta.setdefault('user_states', {})
+            state = states.setdefault(user_key, {"next_counter": None, "date_info": {}, "amp_counter": {}})
+            state['next_counter'] = new_counter
 
         return jsonify({'success': True, 'new_counter': new_counter})
     except Exception as e:
@@ -814,13 +1224,14 @@ def update_counter():
 @app.route('/submit', methods=['POST'])
 def submit_data():
     try:
-        form_data = request.json
+        form_data = request.get_json(cache=False)
         required_fields = ['user_first_name', 'date', 'marmoset', 'slab', 'tile', 'hemisphere', 'tile_location', 'sort_method',
                            'rxn_number', 'sorter_initials']
         for field in required_fields:
             if not form_data.get(field):
                 return jsonify({'success': False, 'error': f'Missing required field: {field}'})
-        success = data_logger.process_form_data(form_data)
+        inputs = FormInputs.from_json(form_data)
+        success = data_logger.process_form_data(inputs)
         return jsonify({'success': True, 'message': 'Data saved successfully!'}) if success else jsonify({'success': False, 'error': 'Failed to process data'})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -833,14 +1244,25 @@ def download_excel():
         if not user_first_name:
             return jsonify({'error': 'Missing user name in query parameter ?user='}), 400
         user_key = data_logger._safe_user_key(user_first_name)
-        object_name = data_logger._load_pointer(user_key)
-        if not object_name:
-            object_name = data_logger._new_object_name(user_key)
+        object_name, new_pointer, _ = data_logger._current_object_name(user_key)
+        if new_pointer:
             data_logger._save_pointer(user_key, object_name)
-        data = data_logger._download_workbook_bytes(object_name)
+
+        tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx")
+        tmp.close()
+
+        @after_this_request
+        def _remove_tmp(response):
+            try:
+                os.unlink(tmp.name)
+            except OSError:
+                pass
+            return response
+
+        data_logger._build_workbook_file(object_name, tmp.name)
         filename = os.path.basename(object_name)
         return send_file(
-            io.BytesIO(data),
+            tmp.name,
             as_attachment=True,
             download_name=filename,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'